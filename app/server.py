@@ -1,18 +1,30 @@
 # app/server.py
 import os
 import re
+import gzip
+import html
 import pickle
-from typing import List, Tuple
+import shutil
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from typing import FrozenSet, List, Optional, Tuple
 
 import numpy as np
 import faiss
+import pyarrow as pa
+import torch
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 
+log = logging.getLogger(__name__)
+
 
 # =========================
 # PATHS
@@ -21,21 +33,64 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # projec
 DATA_DIR = os.path.join(BASE_DIR, "data")
 
 FAISS_PATH = os.path.join(DATA_DIR, "faiss_index_e5.index")
+# نسخة IVF مضغوطة (int8) تُبنى مرة واحدة من الفهرس الأصلي (Flat) وتُحفظ بجانبه
+FAISS_IVF_PATH = os.path.join(DATA_DIR, "faiss_index_e5_ivfsq8.index")
+# بصمة الفهرس الأصلي (الحجم، mtime، ntotal) التي بُني منها الكاش، حتى لا نقرأ الأصلي عند كل تشغيل
+FAISS_IVF_SOURCE_PATH = FAISS_IVF_PATH + ".source"
 CHUNKS_PATH = os.path.join(DATA_DIR, "all_chunks_e5.pkl")
+# نفس المقاطع بصيغة Arrow تُقرأ عبر mmap (تُحوَّل من pickle عند كل تحديث له)
+CHUNKS_ARROW_PATH = os.path.join(DATA_DIR, "all_chunks_e5.arrow")
+
+# نسخة ONNX int8 من نموذج E5 (تُصدَّر مرة واحدة إذا كانت optimum مثبتة)
+ONNX_DIR = os.path.join(BASE_DIR, "models", "e5-small-onnx-int8")
 
 # logo/favicons
 LOGO_PATH = os.path.join(DATA_DIR, "logo.png")  # ضعي شعارك هنا
 FAVICON_PATH = LOGO_PATH  # نفس اللوغو
+# يُفحص مرة واحدة عند التشغيل؛ FileResponse يستدعي os.stat لكل طلب ما لم نمرّر stat_result
+FAVICON_STAT = os.stat(FAVICON_PATH) if os.path.exists(FAVICON_PATH) else None
+STATIC_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
 
 # اختياري: صور PNG شفافة للملصقات (إذا وضعتيها)
 # ضعي ملفات PNG هنا: data/stickers/
 STICKER_DIR = os.path.join(DATA_DIR, "stickers")
 
 MODEL_NAME = "intfloat/multilingual-e5-small"
+QUERY_PREFIX = "query: "  # بادئة E5 للأسئلة
+MAX_SEQ_LEN = 128  # الأسئلة قصيرة؛ كلفة الانتباه O(L²)
 TOP_K = 5
 SEARCH_K = 80
 DONT_KNOW_THRESHOLD = 0.85
 
+# تجميع أسئلة /ask المتزامنة في دفعة واحدة للترميز والبحث
+BATCH_MAX = 32
+BATCH_WAIT_S = 0.005
+
+# كاش LRU لأجوبة /ask حسب نص السؤال بعد توحيد المسافات وحالة الأحرف
+ANSWER_CACHE_SIZE = 2048
+
+# IVF + SQ8: nlist ≈ sqrt(N) قائمة، وبايت واحد لكل بُعد بدل 4 (float32)
+INDEX_FACTORY = "IVF{nlist},SQ8"
+NPROBE = 16
+
+def _env_positive_int(name: str, default: int) -> int:
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise RuntimeError(f"{name} must be an integer, got {raw!r}") from None
+    return max(1, value)
+
+# خيوط FAISS/torch لكل عملية: OMP_NUM_THREADS إن وُجد، وإلا نقسم الأنوية على عدد عمليات uvicorn
+# (WEB_CONCURRENCY هو نفس متغير البيئة الذي يقرأه uvicorn لـ --workers؛
+#  أما --workers نفسه فلا يصل إلى التطبيق، لذلك يجب تمرير العدد عبر WEB_CONCURRENCY)
+NUM_THREADS = _env_positive_int(
+    "OMP_NUM_THREADS",
+    max(1, (os.cpu_count() or 1) // _env_positive_int("WEB_CONCURRENCY", 1)),
+)
+
 
 # عتبة "لا أعلم" (إذا الثقة منخفضة)
 
@@ -44,46 +99,279 @@ DONT_KNOW_THRESHOLD = 0.85
 # =========================
 # LOAD
 # =========================
+def _build_ivf(flat: faiss.Index) -> faiss.Index:
+    # نعيد استخدام المتجهات المخزنة في الفهرس الأصلي بدل إعادة ترميز المقاطع
+    embs = np.ascontiguousarray(flat.reconstruct_n(0, flat.ntotal), dtype=np.float32)
+    # متجهات مُطبّعة + Inner Product = cosine بضرب نقطي واحد لكل متجه
+    faiss.normalize_L2(embs)
+    nlist = max(1, int(np.sqrt(flat.ntotal)))
+    ivf = faiss.index_factory(flat.d, INDEX_FACTORY.format(nlist=nlist), faiss.METRIC_INNER_PRODUCT)
+    ivf.train(embs)
+    ivf.add(embs)
+    return ivf
+
+def _is_inner_product(idx: faiss.Index) -> bool:
+    # الـ quantizer (centroids) يجب أن يستخدم IP أيضًا وإلا يختار القوائم بمسافة L2
+    ivf = faiss.extract_index_ivf(idx)
+    return (idx.metric_type == faiss.METRIC_INNER_PRODUCT
+            and ivf.quantizer.metric_type == faiss.METRIC_INNER_PRODUCT)
+
+def _is_stale(cache_path: str, source_path: str) -> bool:
+    # الكاش قديم إذا لم يوجد أو إذا أُعيد توليد الملف المصدر بعده
+    return (not os.path.exists(cache_path)
+            or os.path.getmtime(source_path) > os.path.getmtime(cache_path))
+
+def _source_fingerprint() -> str:
+    st = os.stat(FAISS_PATH)
+    return f"{st.st_size} {st.st_mtime_ns}"
+
+def _read_cached_ivf():
+    # يعيد الكاش فقط إذا بُني من نفس الفهرس الأصلي الحالي؛ وإلا None
+    if not (os.path.exists(FAISS_IVF_PATH) and os.path.exists(FAISS_IVF_SOURCE_PATH)):
+        return None
+    with open(FAISS_IVF_SOURCE_PATH, encoding="utf-8") as f:
+        fingerprint, _, ntotal = f.read().strip().rpartition(" ")
+    if fingerprint != _source_fingerprint():
+        return None
+    idx = faiss.read_index(FAISS_IVF_PATH)
+    if str(idx.ntotal) != ntotal or not _is_inner_product(idx):
+        return None
+    return idx
+
+def _write_atomic(path: str, write) -> None:
+    # كتابة ذرية: عدة عمليات uvicorn قد تبني الكاش في نفس الوقت
+    tmp = f"{path}.{os.getpid()}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+def _load_index() -> faiss.Index:
+    idx = _read_cached_ivf()
+    if idx is None:
+        # الفهرس الأصلي (Flat) يُقرأ فقط عند إعادة البناء
+        fingerprint = _source_fingerprint()
+        idx = _build_ivf(faiss.read_index(FAISS_PATH))
+        _write_atomic(FAISS_IVF_PATH, lambda p: faiss.write_index(idx, p))
+        # البصمة تُكتب بعد الفهرس: إذا انقطعت العملية بينهما يُعاد البناء في التشغيل التالي
+        def write_source(p):
+            with open(p, "w", encoding="utf-8") as f:
+                f.write(f"{fingerprint} {idx.ntotal}")
+        _write_atomic(FAISS_IVF_SOURCE_PATH, write_source)
+    ivf = faiss.extract_index_ivf(idx)
+    ivf.nprobe = NPROBE
+    ivf.parallel_mode = 1  # توزيع القوائم المفحوصة على الخيوط
+    return _to_gpu(idx)
+
+_gpu_res = None
+
+def _to_gpu(idx: faiss.Index) -> faiss.Index:
+    # يتطلب faiss-gpu وبطاقة CUDA؛ غير ذلك نبقى على المعالج
+    global _gpu_res
+    if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return idx
+    try:
+        _gpu_res = faiss.StandardGpuResources()  # يجب أن تبقى حيّة طوال عمر الفهرس
+        return faiss.index_cpu_to_gpu(_gpu_res, 0, idx)
+    except Exception:
+        return idx
+
+def _load_onnx_encoder():
+    # اختياري: بدون optimum/onnxruntime نبقى على SentenceTransformer (PyTorch FP32)
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError:
+        return None
+
+    def export():
+        # التصدير في مجلد مؤقت خاص بالعملية ثم نقل ذري، حتى لا تتشارك عدة عمليات uvicorn نفس المجلد
+        tmp_dir = f"{ONNX_DIR}.{os.getpid()}.tmp"
+        fp32_dir = os.path.join(tmp_dir, "fp32")
+        int8_dir = os.path.join(tmp_dir, "int8")
+        try:
+            ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True).save_pretrained(fp32_dir)
+            quantizer = ORTQuantizer.from_pretrained(fp32_dir)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=int8_dir, quantization_config=qconfig)
+            try:
+                os.replace(int8_dir, ONNX_DIR)
+            except OSError:
+                # عملية أخرى سبقتنا ووضعت النموذج في مكانه
+                if not os.path.exists(os.path.join(ONNX_DIR, "model_quantized.onnx")):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # أي فشل (بدون إنترنت، خطأ في التصدير...) يعيدنا إلى e5 بدل إيقاف الخادم
+    try:
+        if not os.path.exists(os.path.join(ONNX_DIR, "model_quantized.onnx")):
+            export()
+        return ORTModelForFeatureExtraction.from_pretrained(
+            ONNX_DIR, file_name="model_quantized.onnx", provider="CPUExecutionProvider"
+        )
+    except Exception as e:
+        log.warning("ONNX encoder unavailable, falling back to SentenceTransformer: %s", e)
+        return None
+
+faiss.omp_set_num_threads(NUM_THREADS)
+torch.set_num_threads(NUM_THREADS)
+
+# لا نعطّل autograd هنا: الإعداد خاص بخيط الاستيراد فقط؛ embed_queries يستخدم inference_mode بنفسه
 e5 = SentenceTransformer(MODEL_NAME)
-index = faiss.read_index(FAISS_PATH)
-
-with open(CHUNKS_PATH, "rb") as f:
-    chunks: List[str] = pickle.load(f)
+e5.eval()
+e5.max_seq_length = MAX_SEQ_LEN
+e5_onnx = _load_onnx_encoder()
+
+# البادئة ثابتة: تُرمَّز مرة واحدة وتُلصق بمعرفات كل سؤال
+# rstrip: مقطّع XLM-R يُخرج "▁" مستقلة للمسافة الأخيرة، والسؤال يبدأ أصلًا بـ "▁" خاصة به
+PREFIX_IDS: List[int] = e5.tokenizer(QUERY_PREFIX.rstrip(), add_special_tokens=False)["input_ids"]
+
+def _check_prefix_ids(sample: str = "ما هي عاصمة فرنسا؟") -> None:
+    # الفهرس وعتبة "لا أعلم" مبنيان على ترميز "query: " + السؤال؛ أي اختلاف يغيّر كل التضمينات
+    tok = e5.tokenizer
+    ids = [tok.cls_token_id] + PREFIX_IDS + tok(sample, add_special_tokens=False)["input_ids"] + [tok.sep_token_id]
+    if ids != tok(QUERY_PREFIX + sample)["input_ids"]:
+        raise RuntimeError("PREFIX_IDS + question ids do not match the tokenization of QUERY_PREFIX + question")
+
+_check_prefix_ids()
+index = _load_index()
+
+def _load_chunks() -> pa.ChunkedArray:
+    if _is_stale(CHUNKS_ARROW_PATH, CHUNKS_PATH):
+        with open(CHUNKS_PATH, "rb") as f:
+            texts: List[str] = pickle.load(f)
+        table = pa.table({"text": pa.array(texts, type=pa.large_string())})
+        tmp = f"{CHUNKS_ARROW_PATH}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, CHUNKS_ARROW_PATH)
+
+    # صفحات mmap مشتركة بين عمليات uvicorn، ولا تُنشأ سلاسل Python إلا عند الطلب
+    source = pa.memory_map(CHUNKS_ARROW_PATH)
+    return pa.ipc.open_file(source).read_all().column(0)
+
+def _iter_chunks():
+    for batch in chunks.chunks:
+        yield from batch.to_pylist()
+
+chunks = _load_chunks()
+
+# معرفات FAISS هي مواقع المقاطع؛ أي اختلاف يعني أن الفهرس والمقاطع من نسختين مختلفتين
+if index.ntotal != len(chunks):
+    raise RuntimeError(
+        f"FAISS index has {index.ntotal} vectors but {len(chunks)} chunks were loaded; "
+        f"regenerate {FAISS_PATH} and {CHUNKS_PATH} together."
+    )
 
 
 # =========================
 # RETRIEVAL HELPERS
 # =========================
-AR_STOP = set([
+AR_STOP = frozenset([
     "ما","هي","هل","أين","من","في","على","إلى","عن","هذا","هذه","ذلك","تكون","يكون",
-    "كم","متى","لماذا","كيف","ماهو","ماهي","هو","هي","؟"
+    "كم","متى","لماذا","كيف","ماهو","ماهي","هو","؟"
 ])
 
-def _keywords_ar(text: str) -> List[str]:
-    text = re.sub(r"[^\w\s\u0600-\u06FF]", " ", text)
+class _PunctToSpace(dict):
+    # جدول str.translate يعادل re.sub(r"[^\w\s\u0600-\u06FF]", " ", text)
+    # يُملأ عند أول ظهور لكل محرف بدل بناء جدول لكل نطاق Unicode
+    def __missing__(self, c: int):
+        ch = chr(c)
+        keep = ch.isalnum() or ch == "_" or ch.isspace() or 0x0600 <= c <= 0x06FF
+        self[c] = c if keep else " "
+        return self[c]
+
+_PUNCT_TO_SPACE = _PunctToSpace()
+
+# نهاية الجملة: ۔ . ! ؟ أو سطر جديد
+_SENT_END = re.compile(r"[۔.!؟\n]")
+
+def _keywords_ar(text: str, drop_stop: bool = True) -> List[str]:
+    text = text.translate(_PUNCT_TO_SPACE)
     words = [w.strip() for w in text.split() if len(w.strip()) >= 3]
-    words = [w for w in words if w not in AR_STOP]
+    if drop_stop:
+        words = [w for w in words if w not in AR_STOP]
     return list(dict.fromkeys(words))
 
-def retrieve_chunks(question: str, top_k=TOP_K, search_k=SEARCH_K) -> Tuple[List[str], List[float]]:
-    q = "query: " + question.strip()
-    q_emb = e5.encode([q], normalize_embeddings=True).astype("float32")
-    scores, idxs = index.search(q_emb, search_k)
-
-    candidates = [chunks[i] for i in idxs[0]]
-    cand_scores = list(scores[0])
+# كلمات كل مقطع تُحسب مرة واحدة عند التحميل، فيصبح تقييم الكلمات المفتاحية تقاطع مجموعات
+# مصفوفة object في numpy حتى تُفهرس مباشرة بمصفوفة المعرفات القادمة من FAISS
+CHUNK_TOKSETS = np.empty(len(chunks), dtype=object)
+CHUNK_TOKSETS[:] = [frozenset(_keywords_ar(c, drop_stop=False)) for c in _iter_chunks()]
+
+def _kw_scores(kws_set: FrozenSet[str], ids: np.ndarray) -> np.ndarray:
+    toksets = CHUNK_TOKSETS[ids]
+    return np.fromiter((len(kws_set & t) for t in toksets), dtype=np.int32, count=len(toksets))
+
+def _tokenize_queries(questions: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # [CLS] + PREFIX_IDS + السؤال + [SEP] يطابق ترميز "query: " + السؤال (يُتحقق منه في _check_prefix_ids)
+    tok = e5.tokenizer
+    max_q = MAX_SEQ_LEN - len(PREFIX_IDS) - 2
+    enc = tok([q.strip() for q in questions], add_special_tokens=False,
+              truncation=True, max_length=max_q)["input_ids"]
+    rows = [[tok.cls_token_id] + PREFIX_IDS + ids + [tok.sep_token_id] for ids in enc]
+
+    width = max(len(r) for r in rows)
+    input_ids = np.full((len(rows), width), tok.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+    for i, r in enumerate(rows):
+        input_ids[i, :len(r)] = r
+        attention_mask[i, :len(r)] = 1
+    return input_ids, attention_mask
+
+def embed_queries(questions: List[str]) -> np.ndarray:
+    input_ids, attention_mask = _tokenize_queries(questions)
+    if e5_onnx is not None:
+        hidden = e5_onnx(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    else:
+        # نستدعي المحوّل مباشرة بدل e5.encode (بدون مسار النصوص في SentenceTransformer)
+        # inference_mode لكل استدعاء: وضع autograd خاص بكل خيط، و/ask يعمل من خيوط executor
+        with torch.inference_mode():
+            out = e5[0].auto_model(input_ids=torch.from_numpy(input_ids).to(e5.device),
+                                   attention_mask=torch.from_numpy(attention_mask).to(e5.device))
+        hidden = out.last_hidden_state.cpu().numpy()
+
+    # E5: mean pooling على آخر طبقة ثم L2 normalize (نفس إعداد SentenceTransformer)
+    mask = attention_mask[..., None].astype(np.float32)
+    emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    return np.ascontiguousarray(emb.astype(np.float32, copy=False))
+
+def embed_query(question: str) -> np.ndarray:
+    return embed_queries([question])
+
+def _rerank(question: str, cand_scores: np.ndarray, cand_idxs: np.ndarray,
+            top_k: int) -> Tuple[List[str], List[float]]:
+    # IVF قد يعيد -1 إذا لم تكفِ القوائم المفحوصة لملء search_k
+    valid = cand_idxs >= 0
+    cand_idxs, cand_scores = cand_idxs[valid], cand_scores[valid]
+    if len(cand_idxs) == 0:
+        return [], []
+
+    kws_set = frozenset(_keywords_ar(question))
+    kw_scores = _kw_scores(kws_set, cand_idxs)
+
+    # ترتيب (عدد الكلمات المشتركة، ثم التشابه) كمفتاح واحد؛ التشابه ضمن [-1, 1]
+    keys = kw_scores.astype(np.float64) * 1e6 + cand_scores
+    k = min(top_k, len(keys))
+    top = np.argpartition(-keys, k - 1)[:k]
+    top = top[np.argsort(-keys[top], kind="stable")]
+    # النصوص تُجلب فقط لأفضل top_k، لا لكل المرشحين
+    best_ids = cand_idxs[top]
+    return [chunks[int(i)].as_py() for i in best_ids], cand_scores[top].tolist()
+
+def retrieve_chunks_batch(questions: List[str], top_k=TOP_K,
+                          search_k=SEARCH_K) -> List[Tuple[List[str], List[float]]]:
+    q_embs = embed_queries(questions)
+    scores, idxs = index.search(q_embs, search_k)
+    return [_rerank(q, scores[i], idxs[i], top_k) for i, q in enumerate(questions)]
 
-    kws = _keywords_ar(question)
-    def kw_score(ch: str) -> int:
-        return sum(1 for w in kws if w in ch)
+def retrieve_chunks(question: str, top_k=TOP_K, search_k=SEARCH_K) -> Tuple[List[str], List[float]]:
+    return retrieve_chunks_batch([question], top_k, search_k)[0]
 
-    ranked = sorted(
-        zip(candidates, cand_scores),
-        key=lambda x: (kw_score(x[0]), x[1]),
-        reverse=True
-    )
-    best = ranked[:top_k]
-    return [b[0] for b in best], [float(b[1]) for b in best]
+# warm-up + فحص: نفس مسار /ask (المقطّع + ONNX أو المحوّل + FAISS) من خيط غير الخيط الرئيسي،
+# لأن /ask يعمل داخل run_in_executor وأي مشكلة خاصة بالخيوط يجب أن تظهر عند التشغيل
+with ThreadPoolExecutor(max_workers=1) as _pool:
+    _pool.submit(retrieve_chunks, "_").result()
 
 def build_answer(question: str, retrieved: List[str], scores: List[float]) -> Tuple[str, float]:
     best_score = scores[0] if scores else 0.0
@@ -103,12 +391,8 @@ def build_answer(question: str, retrieved: List[str], scores: List[float]) -> Tu
     text = retrieved[0].strip()
 
     # نأخذ أول جملة مفيدة (مع حماية)
-    splitters = ["۔", ".", "!", "؟", "\n"]
-    ans = text
-    for s in splitters:
-        if s in ans:
-            ans = ans.split(s)[0].strip()
-            break
+    m = _SENT_END.search(text)
+    ans = text[:m.start()].strip() if m else text
 
     if len(ans) < 18:
         ans = text[:220].strip()
@@ -116,50 +400,152 @@ def build_answer(question: str, retrieved: List[str], scores: List[float]) -> Tu
     return ans, best_score
 
 
+# =========================
+# MICRO-BATCH QUEUE
+# =========================
+# يُنشأ في lifespan؛ None يعني أن التطبيق يعمل بدون startup (مثل TestClient خارج with)
+_ask_queue: Optional["asyncio.Queue[Tuple[str, asyncio.Future]]"] = None
+
+async def _batch_worker(queue: "asyncio.Queue[Tuple[str, asyncio.Future]]"):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WAIT_S
+        while len(batch) < BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        questions = [q for q, _ in batch]
+        try:
+            # الترميز والبحث يحجبان المعالج، فنشغلهما خارج حلقة الأحداث
+            results = await loop.run_in_executor(None, retrieve_chunks_batch, questions)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    global _ask_queue
+    _ask_queue = asyncio.Queue()
+    worker = asyncio.create_task(_batch_worker(_ask_queue))
+    try:
+        yield
+    finally:
+        worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await worker
+        _ask_queue = None
+
+
 # =========================
 # FASTAPI
 # =========================
-app = FastAPI(title="smARtABIC Agent")
+app = FastAPI(title="smARtABIC Agent", lifespan=_lifespan)
+
+class _CachedStaticFiles(StaticFiles):
+    # اللوغو والملصقات تُحمَّل في كل زيارة للصفحة؛ نفس Cache-Control الخاص بـ favicon
+    def file_response(self, *args, **kwargs) -> Response:
+        resp = super().file_response(*args, **kwargs)
+        resp.headers.update(STATIC_CACHE_HEADERS)
+        return resp
 
 # static files: logo + stickers
-app.mount("/static", StaticFiles(directory=DATA_DIR), name="static")
+app.mount("/static", _CachedStaticFiles(directory=DATA_DIR), name="static")
 
 class AskRequest(BaseModel):
     question: str
 
 
+# =========================
+# ANSWER CACHE
+# =========================
+# يُستخدم فقط من حلقة الأحداث، فلا حاجة لقفل
+Answer = Tuple[str, float, Tuple[str, ...], Tuple[float, ...]]
+_answer_cache: "OrderedDict[str, Answer]" = OrderedDict()
+
+def _cache_key(question: str) -> str:
+    return " ".join(question.split()).lower()
+
+def _cache_get(key: str):
+    hit = _answer_cache.get(key)
+    if hit is not None:
+        _answer_cache.move_to_end(key)
+    return hit
+
+def _cache_put(key: str, value: Answer) -> None:
+    _answer_cache[key] = value
+    _answer_cache.move_to_end(key)
+    if len(_answer_cache) > ANSWER_CACHE_SIZE:
+        _answer_cache.popitem(last=False)
+
+async def _answer_for(question: str) -> Answer:
+    key = _cache_key(question)
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
+
+    loop = asyncio.get_running_loop()
+    if _ask_queue is None:
+        # بدون عامل التجميع: سؤال واحد مباشرة خارج حلقة الأحداث
+        retrieved, scores = await loop.run_in_executor(None, retrieve_chunks, question)
+    else:
+        fut = loop.create_future()
+        await _ask_queue.put((question, fut))
+        retrieved, scores = await fut
+    answer, best_score = build_answer(question, retrieved, scores)
+
+    show_chunks = retrieved
+    show_scores = scores
+    if answer.startswith("لا أعلم"):
+        show_chunks = []
+        show_scores = []
+
+    # التهريب يتم هنا مرة واحدة (ويُخزَّن في الكاش) بدل regex في المتصفح لكل مقطع
+    retrieved_html = tuple(html.escape(c, quote=False) for c in show_chunks)
+    result = (answer, float(best_score), retrieved_html, tuple(show_scores))
+    _cache_put(key, result)
+    return result
+
+
 # =========================
 # ROUTES
 # =========================
 @app.get("/favicon.ico")
-def favicon():
-    if os.path.exists(FAVICON_PATH):
-        return FileResponse(FAVICON_PATH)
+async def favicon():
+    if FAVICON_STAT is not None:
+        return FileResponse(FAVICON_PATH, headers=STATIC_CACHE_HEADERS, stat_result=FAVICON_STAT)
     # fallback: لا favicon
     return JSONResponse({"detail": "favicon not found"}, status_code=404)
 
 @app.get("/", response_class=HTMLResponse)
-def home():
-    return HTMLResponse(_home_html())
+async def home(req: Request):
+    if "gzip" in req.headers.get("accept-encoding", ""):
+        return Response(HOME_HTML_GZ, media_type="text/html",
+                        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return HTMLResponse(HOME_HTML, headers={"Vary": "Accept-Encoding"})
 
 @app.post("/ask")
-def ask(req: AskRequest):
+async def ask(req: AskRequest):
     question = (req.question or "").strip()
-    retrieved, scores = retrieve_chunks(question)
-    answer, best_score = build_answer(question, retrieved, scores)
-
-    show_chunks = retrieved
-    show_scores = scores
-    if answer.startswith("لا أعلم"):
-        show_chunks = []
-        show_scores = []
+    answer, best_score, retrieved_html, show_scores = await _answer_for(question)
 
     return JSONResponse({
         "question": question,
         "answer": answer,
-        "best_score": float(best_score),
-        "chunks": show_chunks,
-        "scores": show_scores
+        "best_score": best_score,
+        "retrieved_html": list(retrieved_html),
+        "scores": list(show_scores)
     })
 
 
@@ -741,20 +1127,15 @@ def _home_html() -> str:
 
     const chunksDiv = document.getElementById("chunks");
     chunksDiv.innerHTML = "";
-    data.chunks.forEach((ch, i) => {{
+    // retrieved_html مُهرَّبة مسبقًا في الخادم (html.escape)
+    data.retrieved_html.forEach((ch, i) => {{
       const d = document.createElement("div");
       d.className = "chunk";
-      d.innerHTML = `<span class="score">score=${{data.scores[i].toFixed(4)}} | مقطع ${{i+1}}</span>${{escapeHtml(ch)}}`;
+      d.innerHTML = `<span class="score">score=${{data.scores[i].toFixed(4)}} | مقطع ${{i+1}}</span>${{ch}}`;
       chunksDiv.appendChild(d);
     }});
   }}
 
-  function escapeHtml(str){{
-    return str.replace(/[&<>"']/g, function(m) {{
-      return ({{"&":"&amp;","<":"&lt;",">":"&gt;","\\"":"&quot;","'":"&#39;"}})[m];
-    }});
-  }}
-
   document.getElementById("q").addEventListener("keydown", (e) => {{
     if(e.key === "Enter") ask();
   }});
@@ -803,6 +1184,10 @@ def _home_html() -> str:
 </html>
 """
 
+# الصفحة ثابتة: تُبنى وتُضغط مرة واحدة عند التحميل
+HOME_HTML = _home_html()
+HOME_HTML_GZ = gzip.compress(HOME_HTML.encode("utf-8"), 9)
+
 
 """
 =========================
@@ -822,6 +1207,16 @@ def _home_html() -> str:
 3) التشغيل:
    python -m uvicorn app.server:app --host 127.0.0.1 --port 8000
 
+   للإنتاج (عدة عمليات + uvloop/httptools):
+   WEB_CONCURRENCY=$(nproc) python -m uvicorn app.server:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools
+   - WEB_CONCURRENCY يحدد عدد العمليات، وكل عملية تأخذ nproc / WEB_CONCURRENCY خيطًا لـ FAISS و torch
+     (أو OMP_NUM_THREADS إن حُدِّد) حتى لا يصبح عدد الخيوط nproc².
+   - لا تستخدمي --workers: التطبيق لا يرى قيمته، فتأخذ كل عملية nproc خيطًا.
+   - كل عملية تحمّل فهرس FAISS ونموذج E5 الخاصين بها (ذاكرة × عدد العمليات).
+   - ملف المقاطع Arrow مقروء عبر mmap، فصفحاته مشتركة بين العمليات.
+   - مع faiss-gpu: عملية واحدة لكل بطاقة GPU.
+   - يفضَّل تشغيل الخادم مرة بعملية واحدة أولًا لبناء ملفات الكاش (الفهرس IVF و Arrow).
+
 4) Offline؟
    - واجهة الموقع تعمل بدون إنترنت لأنك تفتحين 127.0.0.1 محليًا.
    - لكن نموذج SentenceTransformer قد يحتاج إنترنت "أول مرة فقط" لتنزيله.